@@ -4,7 +4,67 @@
 # --- CryoCon Temperature Controller
 # For use with a CryoCon 22C Temperature Controller
 
+import re
+import time
+
 import easy_scpi as scpi
+import pyvisa
+
+
+# canonical channels and loops
+_CHANNELS = ( 'a', 'b' )
+_LOOPS = ( '1', '2', '3', '4' )
+
+# query commands
+_INPUT_NAME = { ch: f'input {ch}:name?' for ch in _CHANNELS }
+_INPUT_UNITS = { ch: f'input {ch}:units?' for ch in _CHANNELS }
+_INPUT_TEMP = { ch: f'input? {ch}' for ch in _CHANNELS }
+_LOOP_SOURCE = { loop: f'loop {loop}:source?' for loop in _LOOPS }
+_LOOP_RANGE = { loop: f'loop {loop}:range?' for loop in _LOOPS }
+_LOOP_OUTPUT = { loop: f'loop {loop}:outpwr?' for loop in _LOOPS }
+_LOOP_MAXSET = { loop: f'loop {loop}:maxset?' for loop in _LOOPS }
+_LOOP_SETPT = { loop: f'loop {loop}:setpt?' for loop in _LOOPS }
+
+# output ranges, from lowest to highest power
+_RANGES = ( 'low', 'mid', 'hi' )
+_RANGE_IDX = { rng: i for i, rng in enumerate( _RANGES ) }
+
+# trailing units and whitespace of a temperature
+_TEMP_STRIP = re.compile( r'[A-Za-z\s]+$' )
+
+
+def _change_range( curr, change ):
+    """
+    Gets the range relative to the given differing by change.
+
+    :param curr: Name of current range.
+        Values in [ 'low', 'mid', 'hi' ].
+    :param change: Step to attempt change.
+    :returns: Name of new range given the current position and change, or None if change goes outside of bounds.
+        Values in [ 'low', 'mid', 'hi', None ]
+    """
+    pos = _RANGE_IDX[ curr ] + change
+    if ( pos < 0 ) or ( pos >= len( _RANGES ) ):
+        # index out of bounds
+        return None
+
+    return _RANGES[ pos ]
+
+
+def _loop_command( commands, loop ):
+    """
+    Gets the command for the given loop.
+
+    :param commands: Dictionary of loop:command pairs.
+    :param loop: The loop to get the command of.
+    :returns: The command for the loop.
+    :raises ValueError: If the loop is not valid.
+    """
+    try:
+        return commands[ str( loop ) ]
+
+    except KeyError:
+        raise ValueError( f'Unknown loop {loop}.' ) from None
 
 
 class CryoconController( scpi.Instrument ):
@@ -17,6 +77,9 @@ class CryoconController( scpi.Instrument ):
     To read an property:  inst.p1.p2.p3()
     To call a function:   inst.p1.p2( 'value' )
     To execute a command: inst.p1.p2.p3( '' )
+
+    The controller responds to every command, including settings,
+    so settings are sent as queries to keep commands and responses in sync.
     """
 
     # --- methods ---
@@ -27,6 +90,7 @@ class CryoconController( scpi.Instrument ):
         timeout = 10,
         baud = 9600,
         backend = '@py',
+        cache_ttl = 0.5,
         **resource_params
     ):
         """
@@ -38,6 +102,8 @@ class CryoconController( scpi.Instrument ):
         :param backend: VISA backend to use. 
             See https://pyvisa.readthedocs.io/en/latest/introduction/getting.html#backend for more info.
             [Default: '@py']
+        :param cache_ttl: Time in seconds query results are cached for.
+            Use 0 to disable caching. [Default: 0.5]
         :param **resource_params: Arguments sent to the resource upon connection.
             See https://pypi.org/project/easy-scpi/ for more info.
         """
@@ -50,25 +116,65 @@ class CryoconController( scpi.Instrument ):
             backend = backend
         )
 
-        self.__channels = {}
+        self._channels = {}
         self.__channel_names = {}
-        self.__loops = None
+        self._loops = None
         self.__max_temps = None
-        self.__units = None
+        self._units = None
+
+        # reverse lookups, populated on connect
+        self._name_to_channel = {}
+        self._channel_to_loop = {}
+        self._channel_lookup = {}  # raw name:channel cache
+
+        self.cache_ttl = cache_ttl
+        self.__cache = {}
 
 
     def connect( self ):
         super().connect()
-        self.__channels = {
+        self._invalidate_cache()
+        self._name_to_channel = {}
+        self._channel_to_loop = {}
+        self._channel_lookup = {}
+        self._channels = {
             # canonical channel names
             'a': [ 'cha' ],
             'b': [ 'chb' ]
         }
-        self.__initialize_channel_names()  # user channel names
 
-        self.__loops = self.__initialize_loop_sources()
-        self.__units = self.__initialize_units()
-        self.__max_temps = self.__initialize_max_temps()
+        # read all initialization values in one compound query
+        cmds = (
+            [ _INPUT_NAME[ ch ] for ch in _CHANNELS ] +
+            [ _LOOP_SOURCE[ loop ] for loop in _LOOPS ] +
+            [ _INPUT_UNITS[ ch ] for ch in _CHANNELS ] +
+            [ _LOOP_MAXSET[ loop ] for loop in _LOOPS ]
+        )
+        resp = self._batch_query( cmds )
+
+        self.__initialize_channel_names( resp[ 0:2 ] )  # user channel names
+        self._loops = self.__initialize_loop_sources( resp[ 2:6 ] )
+        self._units = self.__initialize_units( resp[ 6:8 ] )
+        self.__max_temps = {
+            loop: self.temp2float( temp )
+            for loop, temp in zip( _LOOPS, resp[ 8:12 ] )
+        }
+
+        name_to_channel = {}
+        for ch, names in self._channels.items():
+            for name in [ ch, *names ]:
+                # first matching channel takes precedence
+                name_to_channel.setdefault( name, ch )
+
+        channel_to_loop = {}
+        for loop in [ '1', '2' ]:
+            # loops 1 and 2 are controlled
+            ch = self.get_channel_by_name( self._loops[ loop ] )
+            if ch is not None:
+                channel_to_loop.setdefault( ch, loop )
+
+        self._name_to_channel = name_to_channel
+        self._channel_to_loop = channel_to_loop
 
         # lock keypad, turn remote LED on
         self.lock( True )
@@ -87,62 +193,113 @@ class CryoconController( scpi.Instrument ):
         :param name: The new name of the channel.
         """
         name = name.strip().lower()
-        self.channels[ channel ].append( name )
+        self._channels[ channel ].append( name )
 
 
-    def __initialize_channel_names( self ):
+    def _batch_query( self, cmds ):
         """
-        Gets the user channel name of each channel.
+        Performs multiple queries in a single compound SCPI message.
+        Falls back to individual queries if the compound query fails
+        or its response is invalid.
+
+        :param cmds: List of query commands.
+        :returns: List of responses, in the same order as the commands.
         """
-        for chan in self.channels:
-            name = self.channel_name( chan )
-            self.__channel_names[ chan ] = name
-            self.__add_name_to_channel( chan, name )
+        try:
+            resp = self.query( ';:'.join( cmds ) )
+            resp = [ r.strip() for r in resp.split( ';' ) ]
+
+        except pyvisa.errors.VisaIOError:
+            resp = None
 
+        if ( resp is None ) or ( len( resp ) != len( cmds ) ):
+            # compound query rejected, discard any unread response
+            # so individual queries stay in sync
+            self.instrument.clear()
+            resp = [ self.query( cmd ).strip() for cmd in cmds ]
 
+        return resp
 
-    def __initialize_loop_sources( self ):
+
+    def _cached_query( self, cmd, ttl = None ):
         """
-        Returns the source for each loop.
+        Performs a query, returning the cached response if it is recent enough.
 
-        :returns: A dictionary of loop:channel source pairs.
+        :param cmd: The query command.
+        :param ttl: Time in seconds a cached response is valid for,
+            or None to use the instance's cache_ttl. [Default: None]
+        :returns: The response to the query.
         """
-        loops = { '1': None, '2': None, '3': None, '4': None }
-        for loop in loops:
-            source = self.query( 'loop {}:source?'.format( loop ) )
-            loops[ loop ] = source.lower()
+        if ttl is None:
+            ttl = self.cache_ttl
 
-        return loops
+        now = time.monotonic()
+        cached = self.__cache.get( cmd )
+        if ( cached is not None ) and ( ( now - cached[ 0 ] ) < ttl ):
+            return cached[ 1 ]
+
+        resp = self.query( cmd )
+        self.__cache[ cmd ] = ( now, resp )
+
+        return resp
 
 
-    def __initialize_max_temps( self ):
+    def _invalidate_cache( self, prefix = '' ):
         """
-        Get the maximum set point temperature for each loop.
+        Removes cached query responses.
 
-        :returns: A dictionary of loop:temperature pairs.
+        :param prefix: Only remove responses whose command begins with prefix.
+            [Default: '', removes all]
         """
-        temps = { '1': None, '2': None, '3': None, '4': None }
-        for loop in temps:
-            ch = self.get_channel_by_name( self.loops[ loop ] )
-            units = self.units[ ch ]
+        for cmd in [ cmd for cmd in self.__cache if cmd.startswith( prefix ) ]:
+            del self.__cache[ cmd ]
 
-            temp = self.max_temperature( loop )
-            temps[ loop ] = self.temp2float( temp, ch )
 
-        return temps
+    def _invalidate_range( self, loop ):
+        """
+        Removes cached responses that depend on the range of the given loop.
+        Output is reported relative to the range, so it is removed as well.
 
+        :param loop: The loop whose range changed.
+        """
+        self._invalidate_cache( f'loop {loop}:range' )
+        self._invalidate_cache( f'loop {loop}:outpwr' )
 
-    def __initialize_units( self ):
+
+    def __initialize_channel_names( self, names ):
+        """
+        Sets the user channel name of each channel.
+
+        :param names: List of user channel names, ordered as channels [ 'a', 'b' ].
+        """
+        for chan, name in zip( _CHANNELS, names ):
+            name = name.strip()
+            self.__channel_names[ chan ] = name
+            self.__add_name_to_channel( chan, name )
+
+
+    def __initialize_loop_sources( self, sources ):
+        """
+        Returns the source for each loop.
+
+        :param sources: List of loop sources, ordered as loops [ '1', '2', '3', '4' ].
+        :returns: A dictionary of loop:channel source pairs.
+        """
+        loops = { '1': None, '2': None, '3': None, '4': None }
+        for loop, source in zip( loops, sources ):
+            loops[ loop ] = source.lower()
+
+        return loops
+
+
+    def __initialize_units( self, units ):
         """
         Gets the units for each input channel.
 
+        :param units: List of units, ordered as channels [ 'a', 'b' ].
         :returns: A dictionary channel:unit pairs
         """
-        units = { 'a': None, 'b': None }
-        for ch in units:
-            units[ ch ] = self.query( 'input {}:units?'.format( ch ) )
-
-        return units
+        return dict( zip( _CHANNELS, units ) )
 
 
     def get_channel_by_name( self, name ):
@@ -152,10 +309,20 @@ class CryoconController( scpi.Instrument ):
         :param name: A name describing the desired channel.
         :returns: The canonical channel name ('a' or 'b') or None if no match.
         """
-        name = name.strip().lower()
+        channel = self._channel_lookup.get( name )
+        if channel is not None:
+            return channel
+
+        key = name.strip().lower()
+        if self._name_to_channel:
+            channel = self._name_to_channel.get( key )
+            if channel is not None:
+                self._channel_lookup[ name ] = channel
 
-        for channel, c_names in self.channels.items():
-            if ( name == channel ) or ( name in c_names ):
+            return channel
+
+        for channel, c_names in self._channels.items():
+            if ( key == channel ) or ( key in c_names ):
                 return channel
 
         # no match
@@ -163,7 +330,11 @@ class CryoconController( scpi.Instrument ):
 
 
     def channel_name( self, channel ):
-        name = self.query( 'input {}:name?'.format( channel ) )
+        ch = self.get_channel_by_name( channel )
+        if ch is None:
+            raise ValueError( f'Unknown channel {channel}.' )
+
+        name = self._cached_query( _INPUT_NAME[ ch ] )
         return name.strip()
 
 
@@ -175,10 +346,12 @@ class CryoconController( scpi.Instrument ):
         :returns: The controlled loop.
         """
         channel = self.get_channel_by_name( channel )
+        if self._channel_to_loop:
+            return self._channel_to_loop.get( channel )
 
         for loop in [ '1', '2' ]:
             # loops 1 and 2 are controlled
-            source = self.loops[ loop ]
+            source = self._loops[ loop ]
             source = self.get_channel_by_name( source )
             if source == channel:
                 return loop
@@ -189,7 +362,7 @@ class CryoconController( scpi.Instrument ):
 
     @property
     def channels( self ):
-        return self.__channels
+        return self._channels
 
 
     @property
@@ -199,7 +372,7 @@ class CryoconController( scpi.Instrument ):
 
     @property
     def loops( self ):
-        return self.__loops
+        return self._loops
 
 
     @property
@@ -209,7 +382,7 @@ class CryoconController( scpi.Instrument ):
 
     @property
     def units( self ):
-        return self.__units
+        return self._units
 
 
     @property
@@ -233,7 +406,7 @@ class CryoconController( scpi.Instrument ):
         :returns: The range of the loop.
             Values are [ 'HI', 'MID', 'LOW' ]
         """
-        rng = self.query( 'loop {}:range?'.format( loop ) )
+        rng = self._cached_query( _loop_command( _LOOP_RANGE, loop ) )
         return rng.lower().strip()
 
 
@@ -245,7 +418,8 @@ class CryoconController( scpi.Instrument ):
         :param rng: The range to set.
             Values are [ 'hi', 'mid', 'low' ]
         """
-        self.query( 'loop {}:range {}'.format( loop, rng ) )
+        self.query( f'loop {loop}:range {rng}' )
+        self._invalidate_range( loop )
 
 
     def get_output( self, loop ):
@@ -255,13 +429,33 @@ class CryoconController( scpi.Instrument ):
         :param loop: The loop to examine.
         :returns: The fraction of the full range output power being applied.
         """
-        pwr = self.query( 'loop {}:outpwr?'.format( loop ) )
+        pwr = self._cached_query( _loop_command( _LOOP_OUTPUT, loop ) )
         pwr = float( pwr )
         pwr /= 100
 
         return pwr
 
 
+    def _snapshot_loops( self, loops ):
+        """
+        Gets the output and range of the given loops in a single query.
+
+        :param loops: List of loops to examine.
+        :returns: A dictionary of loop:( output, range ) pairs.
+            Output is given as a fraction of the full range output power.
+        """
+        cmds = []
+        for loop in loops:
+            cmds.append( _LOOP_OUTPUT[ loop ] )
+            cmds.append( _LOOP_RANGE[ loop ] )
+
+        resp = self._batch_query( cmds )
+        return {
+            loop: ( float( resp[ 2* i ] )/ 100, resp[ 2* i + 1 ].lower() )
+            for i, loop in enumerate( loops )
+        }
+
+
     def max_temperature( self, loop ):
         """
         Returns the maximum set point temperature for the given loop.
@@ -269,7 +463,7 @@ class CryoconController( scpi.Instrument ):
         :param loop: The loop to examine.
         :returns: The maximum set point of the loop.
         """
-        return self.query( 'loop {}:maxset?'.format( loop ) )
+        return self.query( _loop_command( _LOOP_MAXSET, loop ) )
 
 
     def channel_max_temperature( self, channel ):
@@ -294,8 +488,11 @@ class CryoconController( scpi.Instrument ):
             Valid values are [ 'a', 'A', 'b', 'B' ] or the channel name.
         :returns: The current temperature of teh channel.
         """
-        channel = self.get_channel_by_name( channel )
-        temp = self.query( 'input? {}'.format( channel ) )
+        ch = self.get_channel_by_name( channel )
+        if ch is None:
+            raise ValueError( f'Unknown channel {channel}.' )
+
+        temp = self._cached_query( _INPUT_TEMP[ ch ] )
 
         return float( temp )
 
@@ -313,9 +510,9 @@ class CryoconController( scpi.Instrument ):
             # No loop found corresponding to channel
             return None
 
-        setpt = self.query( 'loop {}:setpt?'.format( loop ) )
+        setpt = self._cached_query( _LOOP_SETPT[ loop ] )
 
-        return self.temp2float( setpt, channel )
+        return self.temp2float( setpt )
 
 
     def set_temperature( self, channel, temperature ):
@@ -326,12 +523,14 @@ class CryoconController( scpi.Instrument ):
         :param temperature: The nwe set point temperature.
         """
         loop = self.get_channel_loop( channel )
-        max_temp = self.max_temps[ loop ]
+        if loop is None:
+            raise RuntimeError( 'No loop is controlled by the channel.' )
 
-        if temperature > max_temp:
+        if temperature > self.__max_temps[ loop ]:
             raise RuntimeError( 'Temperature is above maximum.' )
 
-        self.query( 'loop {}:setpt {}'.format( loop, temperature ) )
+        self.query( f'loop {loop}:setpt {temperature}' )
+        self._invalidate_cache( f'loop {loop}:setpt' )
 
 
     def enable( self ):
@@ -339,12 +538,14 @@ class CryoconController( scpi.Instrument ):
         Engages control of the controller.
         """
         self.query( 'control' )
+        self._invalidate_cache()
 
     def disable( self ):
         """
         Disable the temperature controller.
         """
         self.query( 'stop' )
+        self._invalidate_cache()
 
 
     def lock( self, lock ):
@@ -354,21 +555,19 @@ class CryoconController( scpi.Instrument ):
         :param lock: A boolean of whether to lock (True) or unlock (False) teh keypad.
         """
         lock = 'on' if lock else 'off'
-        self.query( 'system:lock {}'.format( lock ) )
+        self.query( f'system:lock {lock}' )
 
 
-    def temp2float( self, temp, channel ):
+    def temp2float( self, temp, channel = None ):
         """
         Converts a temeprature from a given channel to a float.
         Removes units from number part.
 
         :param temp: The temperature string.
-        :param channel: Channel the temperature was acquired from.
+        :param channel: Unused, kept for compatibility. [Default: None]
         :returns:Float value of the temperature string.
         """
-        channel = self.get_channel_by_name( channel )
-        temp = temp.replace( self.units[ channel ], '' )
-        return float( temp )
+        return float( _TEMP_STRIP.sub( '', temp ) )
 
 
     def auto_adjust_range( self, threshold_low  = 0.09, threshold_high = 0.95, channels = None ):
@@ -382,43 +581,26 @@ class CryoconController( scpi.Instrument ):
         :param channels: List of channels to control, or None to control all. [Default: None]
         """
 
-        def change_range( curr, change ):
-            """
-            Gets the range relative to the given differing by change.
-
-            :param curr: Name of current range.
-                Values in [ 'low', 'mid', 'high' ].
-            :param change: Step to attempt change.
-            :returns: Name of new range given the current position and change, or None if change goes outside of bounds.
-                Values in [ 'low', 'mid', 'high', None ]
-            """
-            ranges = [ 'low', 'mid', 'hi' ]
-            pos = ranges.index( curr )
-            pos += change
-
-            if ( pos < 0 ) or ( pos >= len( ranges ) ):
-                # index out of bounds
-                return None
-
-            return ranges[ pos ]
-
-
         if channels is None:
-            channels = self.channels.keys()
+            channels = self._channels.keys()
 
+        get_loop = self.get_channel_loop
+        loops = []
         for ch in channels:
-            loop = self.inst.get_channel_loop( ch )
-            if loop is None:
-                continue
+            loop = get_loop( ch )
+            if ( loop is not None ) and ( loop not in loops ):
+                loops.append( loop )
+
+        if not loops:
+            return
 
-            output = self.inst.get_output( loop )
-            rng = self.inst.get_range( loop )
+        for loop, ( output, rng ) in self._snapshot_loops( loops ).items():
             new_rng = None
             if output < threshold_low:
-                new_rng = change_range( rng, -1 )
+                new_rng = _change_range( rng, -1 )
 
             elif output > threshold_high:
-                new_rng = change_range( rng, 1 )
+                new_rng = _change_range( rng, 1 )
 
             if new_rng is not None:
-                 self.inst.set_range( loop, new_rng )
+                self.set_range( loop, new_rng )
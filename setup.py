@@ -31,6 +31,7 @@ setuptools.setup(
     ],
     install_requires=[
         'easy-scpi',
+        'pyvisa',
         'pyvisa-py'
     ]
 )
\ No newline at end of file